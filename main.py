@@ -1,10 +1,16 @@
+import asyncio
 import logging
-import base64
-import requests
-import json
-from io import BytesIO
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+import re
+import tempfile
+import aiohttp
+import orjson
+import pybase64
+from async_lru import alru_cache
+from collections import OrderedDict
+from typing import Optional, Union
+from telegram import Document, InputFile, Message, PhotoSize, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler, PersistenceInput, PicklePersistence, filters, ContextTypes
 
 # Configure logging
 logging.basicConfig(
@@ -13,27 +19,94 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# PTB and its HTTP client log every Bot API request at INFO - only keep their warnings
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logging.getLogger('telegram').setLevel(logging.WARNING)
+
 # Configuration
 TELEGRAM_BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"  # Replace with your bot token
 ALLOWED_CHAT_ID = 12345678  # Only this chat ID can use the bot
+ALLOWED_CHATS = frozenset({ALLOWED_CHAT_ID})  # Add more chat IDs here to allow them too
 BEARER_TOKEN = "YOUR_BEARER_TOKEN_HERE"  # Replace with your bearer token for upscale API
 BOT_USERNAME = "BOT_USERNAME"  # Replace with your bot's username (without @)
 
+# Where user state (pending images and rename steps) is saved so it survives restarts
+PERSISTENCE_FILE = "bot_state.pkl"
+# Only user_data is saved - bot_data holds the shared HTTP session, which can't be pickled
+PERSISTENCE_STORE = PersistenceInput(bot_data=False, chat_data=False, callback_data=False)
+
+# Number of updates handled in parallel (the Bot API and HTTP connection pools are sized to match)
+CONCURRENT_UPDATES = 32
+
+# Webhook settings - set WEBHOOK_URL (e.g. "https://mydomain") to receive updates by webhook instead of long polling
+WEBHOOK_URL = None
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+
 # API endpoints
 CAPTION_ENDPOINT = "https://example.com/generate-captions"
 UPSCALE_ENDPOINT = "https://example.com/upscale"
 THUMBNAIL_ENDPOINT = "https://example.com/generate-thumbnail"
+IMAGE_ACCEPT = "image/png, application/json;q=0.9"  # Prefer raw PNG results, base64 JSON still works
+
+# Set to True once the upscale/thumbnail endpoints accept raw image uploads as multipart/form-data
+UPSCALE_ACCEPTS_MULTIPART = False
+THUMBNAIL_ACCEPTS_MULTIPART = False
+
+# Set to "gzip" once the API endpoints accept gzip-compressed request bodies (base64 JSON shrinks well)
+UPLOAD_COMPRESSION = None
+
+# Retry settings for API calls that hit rate limiting or gateway errors
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5  # Seconds before the first retry, doubled for each further attempt
+RETRY_MAX_DELAY = 30  # Upper bound for server-requested Retry-After delays
+
+# Streaming settings for large images
+BASE64_CHUNK_SIZE = 192 * 1024  # Must be a multiple of 3 so each chunk encodes without padding
+BASE64_PIPELINE_DEPTH = 4  # Chunks that may be encoding while the next ones download
+BASE64_DECODE_CHUNK_SIZE = 64 * 1024  # Must be a multiple of 4 so each chunk decodes on its own
+RESPONSE_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_SIZE = 2 * 1024 * 1024  # Downloaded results larger than this are spooled to disk
+DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+# Characters outside the base64 alphabet (e.g. line breaks) - removed before decoding in chunks
+_BASE64_IGNORED_RE = re.compile(r'[^A-Za-z0-9+/=]')
 
-def check_chat_permission(chat_id: int) -> bool:
-    """Check if the chat ID is allowed to use the bot"""
-    return chat_id == ALLOWED_CHAT_ID
+# Recently downloaded images are kept so repeated actions on the same image skip the download
+IMAGE_CACHE_SIZE = 64
+IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Captions are cached by input text, so repeated phrases skip the caption endpoint
+CAPTION_CACHE_SIZE = 512
+CAPTION_CACHE_TTL = 3600  # seconds
+
+# Characters removed from new filenames (anything but letters, numbers, spaces, hyphens, underscores)
+_FILENAME_CLEAN_RE = re.compile(r'[^\w\s\-_]')
+# The same rule as a str.translate table for the common all-ASCII case
+_FILENAME_ASCII_TABLE = {c: None for c in range(128) if _FILENAME_CLEAN_RE.match(chr(c))}
+
+# Inline keyboards (built once and reused for every update)
+MAIN_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🔍 Upscale", callback_data="upscale_menu"),
+        InlineKeyboardButton("🖼️ Thumbnail", callback_data="thumbnail")
+    ]
+])
+UPSCALE_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("2x", callback_data="upscale_2x"),
+        InlineKeyboardButton("4x (Default)", callback_data="upscale_4x"),
+        InlineKeyboardButton("8x", callback_data="upscale_8x")
+    ],
+    [InlineKeyboardButton("← Back", callback_data="back_to_main")]
+])
+
+async def unauthorized(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Reply to commands sent from chats that are not allowed to use the bot"""
+    await update.message.reply_text("You are not authorized to use this bot.")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Start command handler"""
-    if not check_chat_permission(update.effective_chat.id):
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     await update.message.reply_text(
         "Welcome! Send me:\n"
         "📷 An image - I'll give you upscale or thumbnail options\n"
@@ -44,10 +117,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def share(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Share command handler - returns HTML formatted message with bot link"""
-    if not check_chat_permission(update.effective_chat.id):
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     # HTML formatted message
     share_message = f"""Telegram ⤵
 <a href="https://t.me/{BOT_USERNAME}">t.me/{BOT_USERNAME}</a>"""
@@ -60,10 +129,6 @@ async def share(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def rename(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Rename command handler - initiates the rename process"""
-    if not check_chat_permission(update.effective_chat.id):
-        await update.message.reply_text("You are not authorized to use this bot.")
-        return
-    
     await update.message.reply_text(
         "📸 Please send me a photo or image document that you want to rename."
     )
@@ -71,11 +136,25 @@ async def rename(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Set user state to waiting for image
     context.user_data['waiting_for_rename_image'] = True
 
+@alru_cache(maxsize=CAPTION_CACHE_SIZE, ttl=CAPTION_CACHE_TTL)
+async def _generate_caption(session: aiohttp.ClientSession, text: str) -> str:
+    """Get a caption for the text from the caption endpoint (failures raise, so they are not cached)"""
+    async with await request_with_retry(
+        session,
+        "GET",
+        CAPTION_ENDPOINT,
+        params={"cap": text},
+        timeout=aiohttp.ClientTimeout(total=30)
+    ) as response:
+        response.raise_for_status()
+        
+        # Parse JSON response and extract only the "result" field
+        result = orjson.loads(await response.read())
+    
+    return result["result"]
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text messages"""
-    if not check_chat_permission(update.effective_chat.id):
-        return
-    
     text = update.message.text
     
     # Check if user is in rename process and waiting for new filename
@@ -86,284 +165,530 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     # Send typing indicator
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
     
+    session = context.bot_data['http']
     try:
         # Call caption generation endpoint
-        params = {"cap": text}
-        response = requests.get(CAPTION_ENDPOINT, params=params, timeout=30)
-        response.raise_for_status()
-        
-        # Parse JSON response and extract only the "result" field
-        result = response.json()
-        if "result" in result:
-            await update.message.reply_text(result["result"])
-        else:
-            await update.message.reply_text("Error: No result found in response.")
+        caption = await _generate_caption(session, text)
+        await update.message.reply_text(caption)
         
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error calling caption endpoint: {e}")
+    except KeyError:
+        await update.message.reply_text("Error: No result found in response.")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error calling caption endpoint: %s", e)
         await update.message.reply_text("Sorry, there was an error processing your text. Please try again later.")
     except Exception as e:
-        logger.error(f"Unexpected error in handle_text: {e}")
+        logger.error("Unexpected error in handle_text: %s", e)
         await update.message.reply_text("An unexpected error occurred. Please try again later.")
 
+def _extract_image(message: Message) -> Optional[Union[PhotoSize, Document]]:
+    """Return the largest photo size or an image document from a message, if any"""
+    if message.photo:
+        return message.photo[-1]
+    document = message.document
+    # Documents may come without a mime type
+    if document and (document.mime_type or '').startswith('image/'):
+        return document
+    return None
+
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle image messages (both photos and documents)"""
-    if not check_chat_permission(update.effective_chat.id):
-        return
+    user_data = context.user_data
     
     # Check if user is in rename process
-    if context.user_data.get('waiting_for_rename_image'):
+    if user_data.get('waiting_for_rename_image'):
         await process_rename_image(update, context)
         return
     
-    # Handle both photo and document types
-    if update.message.photo:
-        # Get the largest photo size
-        photo = update.message.photo[-1]
-        context.user_data['photo_file_id'] = photo.file_id
-    elif update.message.document and update.message.document.mime_type.startswith('image/'):
-        # Handle document images
-        document = update.message.document
-        context.user_data['photo_file_id'] = document.file_id
-    else:
-        return
+    # Drop the download path of the previous image
+    user_data.pop('photo_file_path', None)
     
-    # Create inline keyboard with options
-    keyboard = [
-        [
-            InlineKeyboardButton("🔍 Upscale", callback_data="upscale_menu"),
-            InlineKeyboardButton("🖼️ Thumbnail", callback_data="thumbnail")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    image = _extract_image(update.message)
+    if image is None:
+        return
+    user_data['photo_file_id'] = image.file_id
     
     await update.message.reply_text(
         "What would you like to do with this image?",
-        reply_markup=reply_markup
+        reply_markup=MAIN_MARKUP
     )
+    
+    # Look up the download path while the user picks an option, so processing skips bot.get_file
+    try:
+        file = await image.get_file()
+        # Another image may have arrived meanwhile - only keep the path if it still belongs to the stored one
+        # getFile may return no path, in which case processing falls back to bot.get_file
+        if file.file_path and user_data.get('photo_file_id') == image.file_id:
+            # The full URL contains the bot token, so only the path after it is kept
+            user_data['photo_file_path'] = file.file_path.removeprefix(f"{context.bot.base_file_url}/")
+    except TelegramError as e:
+        logger.warning("Could not resolve file path in handle_image: %s", e)
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle callback queries from inline keyboards"""
     query = update.callback_query
     await query.answer()
     
-    if not check_chat_permission(update.effective_chat.id):
+    # CallbackQueryHandler takes no filters, so the chat is checked here
+    if update.effective_chat.id not in ALLOWED_CHATS:
         return
     
-    if query.data == "upscale_menu":
-        # Show upscale options
-        keyboard = [
-            [
-                InlineKeyboardButton("2x", callback_data="upscale_2x"),
-                InlineKeyboardButton("4x (Default)", callback_data="upscale_4x"),
-                InlineKeyboardButton("8x", callback_data="upscale_8x")
-            ],
-            [InlineKeyboardButton("← Back", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    handler = CALLBACK_HANDLERS.get(query.data)
+    if handler is not None:
+        await handler(update, context)
+    elif query.data.startswith("upscale_"):
+        # upscale_2x, upscale_4x, ... carry the scale factor after the prefix
+        await process_upscale(update, context, query.data[8:])
+
+async def _show_upscale_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show upscale options"""
+    await update.callback_query.edit_message_text(
+        "Choose upscale factor:",
+        reply_markup=UPSCALE_MARKUP
+    )
+
+async def _show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Go back to main options"""
+    await update.callback_query.edit_message_text(
+        "What would you like to do with this image?",
+        reply_markup=MAIN_MARKUP
+    )
+
+async def request_with_retry(session: aiohttp.ClientSession, method: str, url: str, make_body=None, **kwargs) -> aiohttp.ClientResponse:
+    """Send an API request, retrying with backoff on rate limiting and gateway errors"""
+    for attempt in range(MAX_RETRIES + 1):
+        # Streamed bodies can only be sent once, so every attempt builds a fresh one
+        data = make_body() if make_body is not None else None
+        response = await session.request(method, url, data=data, **kwargs)
+        if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
         
-        await query.edit_message_text(
-            "Choose upscale factor:",
-            reply_markup=reply_markup
-        )
+        # Honour Retry-After when the server sends one, otherwise back off exponentially
+        retry_after = response.headers.get('Retry-After', '')
+        delay = min(int(retry_after), RETRY_MAX_DELAY) if retry_after.isdigit() else RETRY_BACKOFF * 2 ** attempt
+        response.release()
+        logger.warning("%s %s returned %s, retrying in %ss", method, url, response.status, delay)
+        await asyncio.sleep(delay)
+
+# Downloaded images by file_id, least recently used first
+_image_cache: "OrderedDict[str, bytearray]" = OrderedDict()
+
+def cache_image(file_id: str, image_bytes: bytearray) -> None:
+    """Remember a downloaded image, evicting the least recently used ones"""
+    _image_cache[file_id] = image_bytes
+    _image_cache.move_to_end(file_id)
+    while len(_image_cache) > 1 and (
+        len(_image_cache) > IMAGE_CACHE_SIZE
+        or sum(len(cached) for cached in _image_cache.values()) > IMAGE_CACHE_MAX_BYTES
+    ):
+        _image_cache.popitem(last=False)
+
+async def iter_image_chunks(context: ContextTypes.DEFAULT_TYPE, file_id: str, file_path: Optional[str] = None):
+    """Yield the image in chunks as it downloads from Telegram (file_path is relative to the bot's file URL)"""
+    # Reuse the download when the user goes back and picks another option for the same image
+    if file_id in _image_cache:
+        _image_cache.move_to_end(file_id)
+        view = memoryview(_image_cache[file_id])
+        for start in range(0, len(view), BASE64_CHUNK_SIZE):
+            yield view[start:start + BASE64_CHUNK_SIZE]
+        return
+    
+    # Stream the file straight from Telegram's file server
+    session = context.bot_data['http']
+    timeout = aiohttp.ClientTimeout(total=60)
+    if file_path is not None:
+        response = await session.get(f"{context.bot.base_file_url}/{file_path}", timeout=timeout)
+        if response.status == 404:
+            # Download paths are only guaranteed for an hour - fall back to a fresh one
+            response.release()
+            file_path = None
+    if file_path is None:
+        file = await context.bot.get_file(file_id)
+        response = await session.get(file.file_path, timeout=timeout)
     
-    elif query.data == "back_to_main":
-        # Go back to main options
-        keyboard = [
-            [
-                InlineKeyboardButton("🔍 Upscale", callback_data="upscale_menu"),
-                InlineKeyboardButton("🖼️ Thumbnail", callback_data="thumbnail")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    async with response:
+        if response.status >= 400:
+            # raise_for_status() would put the download URL, and with it the bot token, into the logs
+            raise aiohttp.ClientError(f"Telegram file download failed with HTTP {response.status}")
         
-        await query.edit_message_text(
-            "What would you like to do with this image?",
-            reply_markup=reply_markup
-        )
+        # Allocate the whole buffer up front (Content-Length is the file_size Telegram
+        # reports) instead of regrowing it as chunks arrive
+        image_bytes = bytearray(response.content_length or 0)
+        offset = 0
+        async for chunk in response.content.iter_chunked(RESPONSE_CHUNK_SIZE):
+            image_bytes[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+            yield chunk
+        del image_bytes[offset:]
     
-    elif query.data.startswith("upscale_"):
-        scale_factor = query.data.split("_")[1]
-        await process_upscale(update, context, scale_factor)
+    # Keep the bytearray itself - converting to bytes would copy the whole image
+    cache_image(file_id, image_bytes)
+
+async def get_image_bytes(context: ContextTypes.DEFAULT_TYPE, file_id: str, file_path: Optional[str] = None) -> bytearray:
+    """Download image as raw bytes"""
+    if file_id not in _image_cache:
+        # Run the download to completion, which fills the cache
+        async for _ in iter_image_chunks(context, file_id, file_path):
+            pass
     
-    elif query.data == "thumbnail":
-        await process_thumbnail(update, context)
+    return _image_cache[file_id]
 
-async def get_image_base64(context: ContextTypes.DEFAULT_TYPE, file_id: str, include_data_url: bool = False) -> str:
-    """Convert image to base64"""
-    file = await context.bot.get_file(file_id)
-    file_bytes = BytesIO()
-    await file.download_to_memory(file_bytes)
-    file_bytes.seek(0)
+async def encode_base64_pipelined(chunks):
+    """Base64-encode chunks in worker threads while the next chunks are still downloading"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=BASE64_PIPELINE_DEPTH)
     
-    # Convert to base64
-    base64_data = base64.b64encode(file_bytes.read()).decode('utf-8')
+    async def produce():
+        try:
+            pending = bytearray()
+            async for chunk in chunks:
+                pending += chunk
+                if len(pending) >= BASE64_CHUNK_SIZE:
+                    # Only encode whole 3-byte groups so no padding ends up mid-stream
+                    # (the slice is already a copy, so the worker never sees pending change)
+                    cut = len(pending) - len(pending) % 3
+                    await queue.put(loop.run_in_executor(None, pybase64.b64encode, pending[:cut]))
+                    del pending[:cut]
+            if pending:
+                await queue.put(loop.run_in_executor(None, pybase64.b64encode, pending))
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+    
+    producer = asyncio.create_task(produce())
+    try:
+        # Yield the encoded chunks in order as their worker threads finish
+        while (item := await queue.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield await item
+    finally:
+        producer.cancel()
+
+async def stream_image_json(chunks, image_key: str, fields: dict, include_data_url: bool = False):
+    """Stream a JSON body with the image base64-encoded chunk by chunk"""
+    # Open the JSON object with the plain fields, then start the image string
+    head = orjson.dumps(fields)[:-1]
+    if fields:
+        head += b","
+    yield head + orjson.dumps(image_key) + b':"'
     
     if include_data_url:
         # Include data URL prefix for upscale endpoint
-        return f"data:image/jpeg;base64,{base64_data}"
-    else:
-        # Return plain base64 for thumbnail endpoint
-        return base64_data
+        yield DATA_URL_PREFIX
+    
+    # Encode chunk by chunk so the full base64 string is never held in memory
+    # (pybase64 uses a SIMD codec where the CPU supports it)
+    async for encoded in encode_base64_pipelined(chunks):
+        yield encoded
+    
+    yield b'"}'
+
+async def spool_response(response: aiohttp.ClientResponse) -> tempfile.SpooledTemporaryFile:
+    """Spool a raw image response as it arrives instead of buffering it in memory"""
+    image_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        async for chunk in response.content.iter_chunked(RESPONSE_CHUNK_SIZE):
+            image_file.write(chunk)
+    except BaseException:
+        image_file.close()
+        raise
+    image_file.seek(0)
+    return image_file
+
+def base64_data_offset(base64_str: str) -> Optional[int]:
+    """Return where the base64 data starts after any data URL prefix (None if a data URL has no comma)"""
+    if not base64_str.startswith('data:image'):
+        return 0
+    # The prefix is usually short, so only look for its comma near the start first
+    comma = base64_str.find(',', 0, 64)
+    if comma == -1:
+        comma = base64_str.find(',')
+    return comma + 1 if comma != -1 else None
+
+def decode_base64_to_spool(base64_str: str, offset: int = 0) -> tempfile.SpooledTemporaryFile:
+    """Decode base64 chunk by chunk (from offset on) into a spooled temporary file"""
+    # Chunks only decode on their own if every character counts towards the 4-character groups
+    if _BASE64_IGNORED_RE.search(base64_str, offset):
+        base64_str = _BASE64_IGNORED_RE.sub('', base64_str[offset:])
+        offset = 0
+    
+    image_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    for start in range(offset, len(base64_str), BASE64_DECODE_CHUNK_SIZE):
+        image_file.write(pybase64.b64decode(base64_str[start:start + BASE64_DECODE_CHUNK_SIZE], validate=False))
+    image_file.seek(0)
+    return image_file
+
+def spool_upload(image_file: tempfile.SpooledTemporaryFile, filename: str) -> InputFile:
+    """Wrap a spooled result for upload to Telegram"""
+    size = image_file.seek(0, 2)
+    image_file.seek(0)
+    if size <= SPOOL_MAX_SIZE:
+        # Still in memory - handing over the file would make the upload call fileno(), which moves it to disk
+        return InputFile(image_file.read(), filename=filename)
+    # Let the upload read from the spooled file instead of loading it back into memory
+    return InputFile(image_file, filename=filename, read_file_handle=False)
+
+async def run_with_upload_action(context: ContextTypes.DEFAULT_TYPE, chat_id: int, func, *args, **kwargs):
+    """Run func in a worker thread while the upload indicator is shown"""
+    # The indicator is only cosmetic, so its failure must not discard the result
+    _, result = await asyncio.gather(
+        context.bot.send_chat_action(chat_id=chat_id, action="upload_document"),
+        asyncio.to_thread(func, *args, **kwargs),
+        return_exceptions=True
+    )
+    if isinstance(result, BaseException):
+        raise result
+    return result
 
 async def process_upscale(update: Update, context: ContextTypes.DEFAULT_TYPE, scale_factor: str) -> None:
     """Process image upscaling"""
     query = update.callback_query
+    user_data = context.user_data
+    chat_id = update.effective_chat.id
+    
+    # Get image
+    photo_file_id = user_data.get('photo_file_id')
+    photo_file_path = user_data.get('photo_file_path')
+    if not photo_file_id:
+        await query.edit_message_text("❌ Error: Image not found. Please send the image again.")
+        return
     
-    # Edit message to show processing
-    await query.edit_message_text("🔄 Processing upscale... Please wait.")
+    # Show the processing message without waiting on it, so fetching the image starts right away
+    status_update = asyncio.create_task(query.edit_message_text("🔄 Processing upscale... Please wait."))
+    image_file = None
     
     try:
-        # Get image base64
-        photo_file_id = context.user_data.get('photo_file_id')
-        if not photo_file_id:
-            await query.edit_message_text("❌ Error: Image not found. Please send the image again.")
-            return
-        
-        # Get base64 with data URL prefix for upscale endpoint
-        base64_image = await get_image_base64(context, photo_file_id, include_data_url=True)
-        
         # Prepare request data according to the expected format
         headers = {
             "Authorization": f"Bearer {BEARER_TOKEN}",
-            "Content-Type": "application/json"
+            "Accept": IMAGE_ACCEPT
         }
         
-        data = {
-            "base64_data": base64_image,  # Changed from "image" to "base64_data"
-            "size": scale_factor  # Changed from "scale" to "size"
-        }
+        if UPSCALE_ACCEPTS_MULTIPART:
+            # Upload the raw image bytes, skipping the base64 round-trip
+            image_bytes = await get_image_bytes(context, photo_file_id, photo_file_path)
+            
+            def make_body():
+                data = aiohttp.FormData()
+                data.add_field("size", scale_factor)
+                data.add_field("image", image_bytes, filename="image.jpg", content_type="image/jpeg")
+                return data
+            compress = None  # Raw image bytes don't compress
+        else:
+            # Stream base64 with data URL prefix for upscale endpoint
+            headers["Content-Type"] = "application/json"
+            
+            def make_body():
+                return stream_image_json(
+                    iter_image_chunks(context, photo_file_id, photo_file_path),
+                    "base64_data",  # Changed from "image" to "base64_data"
+                    {"size": scale_factor},  # Changed from "scale" to "size"
+                    include_data_url=True
+                )
+            compress = UPLOAD_COMPRESSION
         
         # Send request to upscale endpoint with longer timeout for 4x and 8x
         timeout = 120 if scale_factor in ['4x', '8x'] else 60  # 2 minutes for 4x/8x, 1 minute for 2x
-        response = requests.post(
+        session = context.bot_data['http']
+        async with await request_with_retry(
+            session,
+            "POST",
             UPSCALE_ENDPOINT,
+            make_body=make_body,
             headers=headers,
-            json=data,
-            timeout=timeout
-        )
-        response.raise_for_status()
+            compress=compress,
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            response.raise_for_status()
+            
+            if response.content_type.startswith('image/'):
+                # Server returned the upscaled image as raw bytes
+                image_file = await spool_response(response)
+            else:
+                # Parse response
+                result = orjson.loads(await response.read())
+                image_file = None
         
-        # Parse response
-        result = response.json()
+        document = image_file
         
-        # Check if response contains upscaled_base64 field
-        if 'upscaled_base64' in result:
-            # Extract base64 data (remove data URL prefix if present)
+        # Check if response contains a result URL or upscaled_base64 field
+        if document is None and 'url' in result:
+            # Telegram fetches the result from the URL itself, so the image never passes through the bot
+            document = result['url']
+        elif document is None and 'upscaled_base64' in result:
+            # Find where the base64 data starts (skip the data URL prefix if present)
             base64_str = result['upscaled_base64']
-            if base64_str.startswith('data:image'):
-                base64_str = base64_str.split(',')[1]
+            offset = base64_data_offset(base64_str)
             
-            # Decode base64 image
-            image_data = base64.b64decode(base64_str)
-            image_file = BytesIO(image_data)
-            image_file.name = f"upscaled_{scale_factor}.png"  # Set filename for document
+            # A data URL without a comma carries no image, which is reported as an invalid response below
+            if offset is not None:
+                # Decode base64 image in a worker thread, without holding the whole decoded result in memory,
+                # while the upload indicator is shown
+                image_file = await run_with_upload_action(context, chat_id, decode_base64_to_spool, base64_str, offset)
+        
+        if image_file is not None:
+            document = spool_upload(image_file, f"upscaled_{scale_factor}.png")
+        
+        if document is not None:
+            # Only wait for the processing message - a failed edit must not hold back the result
+            await asyncio.wait([status_update])
             
             # Send upscaled image back as document to preserve quality
             await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=image_file,
-                caption=f"✅ Image upscaled {scale_factor}",
-                filename=f"upscaled_{scale_factor}.png"
+                chat_id=chat_id,
+                document=document,
+                caption=f"✅ Image upscaled {scale_factor}"
             )
             
-            # Delete the processing message
+            # Delete the processing message only once the result is there
             await query.delete_message()
-        else:
-            await query.edit_message_text("❌ Error: Invalid response from upscale service.")
+            return
+        
+        error_message = "❌ Error: Invalid response from upscale service."
     
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error in upscale request: {e}")
-        await query.edit_message_text("❌ Error processing upscale. Please try again later.")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error in upscale request: %s", e)
+        error_message = "❌ Error processing upscale. Please try again later."
     except Exception as e:
-        logger.error(f"Unexpected error in process_upscale: {e}")
-        await query.edit_message_text("❌ An unexpected error occurred during upscaling.")
+        logger.error("Unexpected error in process_upscale: %s", e)
+        error_message = "❌ An unexpected error occurred during upscaling."
+    finally:
+        # Close the spooled result however processing ended
+        if image_file is not None:
+            image_file.close()
+    
+    # Let the processing message land first so the error replaces it
+    await asyncio.wait([status_update])
+    try:
+        await query.edit_message_text(error_message)
+    except TelegramError:
+        # The processing message can't be edited (e.g. it was already deleted) - send the error instead
+        await context.bot.send_message(chat_id=chat_id, text=error_message)
 
 async def process_thumbnail(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process thumbnail generation"""
     query = update.callback_query
+    user_data = context.user_data
+    chat_id = update.effective_chat.id
+    
+    # Get image
+    photo_file_id = user_data.get('photo_file_id')
+    photo_file_path = user_data.get('photo_file_path')
+    if not photo_file_id:
+        await query.edit_message_text("❌ Error: Image not found. Please send the image again.")
+        return
     
-    # Edit message to show processing
-    await query.edit_message_text("🔄 Generating thumbnail... Please wait.")
+    # Show the processing message without waiting on it, so fetching the image starts right away
+    status_update = asyncio.create_task(query.edit_message_text("🔄 Generating thumbnail... Please wait."))
+    image_file = None
     
     try:
-        # Get image base64
-        photo_file_id = context.user_data.get('photo_file_id')
-        if not photo_file_id:
-            await query.edit_message_text("❌ Error: Image not found. Please send the image again.")
-            return
-        
-        # Get plain base64 for thumbnail endpoint (no data URL prefix)
-        base64_image = await get_image_base64(context, photo_file_id, include_data_url=False)
-        
         # Prepare request data
         headers = {
-            "Content-Type": "application/json"
+            "Accept": IMAGE_ACCEPT
         }
         
-        data = {
-            "image": base64_image  # Plain base64 as specified
-        }
+        if THUMBNAIL_ACCEPTS_MULTIPART:
+            # Upload the raw image bytes, skipping the base64 round-trip
+            image_bytes = await get_image_bytes(context, photo_file_id, photo_file_path)
+            
+            def make_body():
+                data = aiohttp.FormData()
+                data.add_field("image", image_bytes, filename="image.jpg", content_type="image/jpeg")
+                return data
+            compress = None  # Raw image bytes don't compress
+        else:
+            # Stream plain base64 for thumbnail endpoint (no data URL prefix)
+            headers["Content-Type"] = "application/json"
+            
+            def make_body():
+                return stream_image_json(iter_image_chunks(context, photo_file_id, photo_file_path), "image", {})
+            compress = UPLOAD_COMPRESSION
         
         # Send request to thumbnail endpoint
-        response = requests.post(
+        session = context.bot_data['http']
+        async with await request_with_retry(
+            session,
+            "POST",
             THUMBNAIL_ENDPOINT,
+            make_body=make_body,
             headers=headers,
-            json=data,
-            timeout=45  # Increased timeout for thumbnail generation
-        )
-        response.raise_for_status()
+            compress=compress,
+            timeout=aiohttp.ClientTimeout(total=45)  # Increased timeout for thumbnail generation
+        ) as response:
+            response.raise_for_status()
+            
+            if response.content_type.startswith('image/'):
+                # Server returned the thumbnail as raw bytes
+                image_file = await spool_response(response)
+            else:
+                # Parse response
+                result = orjson.loads(await response.read())
+                image_file = None
         
-        # Parse response
-        result = response.json()
+        document = image_file
         
         # Check if response contains thumbnail field
-        if 'thumbnail' in result:
-            # Decode base64 image
-            image_data = base64.b64decode(result['thumbnail'])
-            image_file = BytesIO(image_data)
-            image_file.name = "thumbnail.png"  # Set filename for document
+        if document is None and 'thumbnail' in result:
+            # Decode base64 image in a worker thread so other updates keep flowing,
+            # while the upload indicator is shown
+            image_data = await run_with_upload_action(context, chat_id, pybase64.b64decode, result['thumbnail'], validate=False)
+            # The decoded bytes are uploaded as they are, without a file-like wrapper
+            document = InputFile(image_data, filename="thumbnail.png")
+        elif document is not None:
+            document = spool_upload(image_file, "thumbnail.png")
+        
+        if document is not None:
+            # Only wait for the processing message - a failed edit must not hold back the result
+            await asyncio.wait([status_update])
             
             # Send thumbnail back as document to preserve quality
             await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=image_file,
-                caption="✅ Thumbnail generated",
-                filename="thumbnail.png"
+                chat_id=chat_id,
+                document=document,
+                caption="✅ Thumbnail generated"
             )
             
-            # Delete the processing message
+            # Delete the processing message only once the result is there
             await query.delete_message()
-        else:
-            await query.edit_message_text("❌ Error: Invalid response from thumbnail service.")
+            return
+        
+        error_message = "❌ Error: Invalid response from thumbnail service."
     
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error in thumbnail request: {e}")
-        await query.edit_message_text("❌ Error generating thumbnail. Please try again later.")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error in thumbnail request: %s", e)
+        error_message = "❌ Error generating thumbnail. Please try again later."
     except Exception as e:
-        logger.error(f"Unexpected error in process_thumbnail: {e}")
-        await query.edit_message_text("❌ An unexpected error occurred during thumbnail generation.")
+        logger.error("Unexpected error in process_thumbnail: %s", e)
+        error_message = "❌ An unexpected error occurred during thumbnail generation."
+    finally:
+        # Close the spooled result however processing ended
+        if image_file is not None:
+            image_file.close()
+    
+    # Let the processing message land first so the error replaces it
+    await asyncio.wait([status_update])
+    try:
+        await query.edit_message_text(error_message)
+    except TelegramError:
+        # The processing message can't be edited (e.g. it was already deleted) - send the error instead
+        await context.bot.send_message(chat_id=chat_id, text=error_message)
 
 async def process_rename_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle image received for renaming"""
+    user_data = context.user_data
+    
     # Store the image file_id for renaming
-    if update.message.photo:
-        # Get the largest photo size
-        photo = update.message.photo[-1]
-        context.user_data['rename_file_id'] = photo.file_id
-        context.user_data['rename_file_type'] = 'photo'
-    elif update.message.document and update.message.document.mime_type.startswith('image/'):
-        # Handle document images
-        document = update.message.document
-        context.user_data['rename_file_id'] = document.file_id
-        context.user_data['rename_file_type'] = 'document'
-    else:
+    image = _extract_image(update.message)
+    if image is None:
         await update.message.reply_text("❌ Please send a valid image file.")
         return
+    user_data['rename_file_id'] = image.file_id
+    user_data['rename_file_type'] = 'photo' if update.message.photo else 'document'
     
     # Clear the waiting flag and set new flag
-    context.user_data['waiting_for_rename_image'] = False
-    context.user_data['waiting_for_rename_filename'] = True
+    user_data['waiting_for_rename_image'] = False
+    user_data['waiting_for_rename_filename'] = True
     
     await update.message.reply_text(
         "✅ Image received! Now please send me the new filename (without extension).\n"
@@ -373,18 +698,24 @@ async def process_rename_image(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def process_rename_with_filename(update: Update, context: ContextTypes.DEFAULT_TYPE, filename: str) -> None:
     """Process the rename with the provided filename"""
+    user_data = context.user_data
+    chat_id = update.effective_chat.id
+    
     try:
         # Get the stored file_id
-        file_id = context.user_data.get('rename_file_id')
+        file_id = user_data.get('rename_file_id')
         if not file_id:
             await update.message.reply_text("❌ Error: No image found. Please start over with /rename")
             # Clear user data
-            context.user_data.clear()
+            user_data.clear()
             return
         
         # Clean the filename (remove special characters, keep only alphanumeric, spaces, hyphens, underscores)
-        import re
-        clean_filename = re.sub(r'[^\w\s\-_]', '', filename.strip())
+        clean_filename = filename.strip()
+        if clean_filename.isascii():
+            clean_filename = clean_filename.translate(_FILENAME_ASCII_TABLE)
+        else:
+            clean_filename = _FILENAME_CLEAN_RE.sub('', clean_filename)
         clean_filename = clean_filename.replace(' ', '_')  # Replace spaces with underscores
         
         if not clean_filename:
@@ -397,20 +728,14 @@ async def process_rename_with_filename(update: Update, context: ContextTypes.DEF
         # Send processing message
         processing_msg = await update.message.reply_text("🔄 Renaming your image... Please wait.")
         
-        # Get the file and download it
-        file = await context.bot.get_file(file_id)
-        file_bytes = BytesIO()
-        await file.download_to_memory(file_bytes)
-        file_bytes.seek(0)
-        
-        # Set the filename for the BytesIO object
-        file_bytes.name = new_filename
+        # Get the file - a new upload is needed because Telegram keeps the original
+        # filename when a document is re-sent by file_id
+        image_bytes = await get_image_bytes(context, file_id)
         
-        # Send the renamed file back as document
+        # Send the renamed file back as document (InputFile takes bytes, not the cached bytearray)
         await context.bot.send_document(
-            chat_id=update.effective_chat.id,
-            document=file_bytes,
-            filename=new_filename,
+            chat_id=chat_id,
+            document=InputFile(bytes(image_bytes), filename=new_filename),
             caption=f"✅ Image renamed to: {new_filename}"
         )
         
@@ -418,31 +743,91 @@ async def process_rename_with_filename(update: Update, context: ContextTypes.DEF
         await processing_msg.delete()
         
         # Clear user data
-        context.user_data.clear()
+        user_data.clear()
         
     except Exception as e:
-        logger.error(f"Error in process_rename_with_filename: {e}")
+        logger.error("Error in process_rename_with_filename: %s", e)
         await update.message.reply_text("❌ An error occurred while renaming the image. Please try again.")
         # Clear user data on error
-        context.user_data.clear()
+        user_data.clear()
+
+# Callback data handled by handle_callback (upscale_<factor> is matched by prefix)
+CALLBACK_HANDLERS = {
+    "upscale_menu": _show_upscale_menu,
+    "back_to_main": _show_main_menu,
+    "thumbnail": process_thumbnail,
+}
+
+async def post_init(application: Application) -> None:
+    """Create the shared HTTP session once the event loop is running"""
+    # Keep connections to the API endpoints alive so repeat calls skip the TCP/TLS handshake
+    connector = aiohttp.TCPConnector(limit=CONCURRENT_UPDATES, limit_per_host=16, keepalive_timeout=75)
+    # Every call sets its own timeout, so the session-wide default is disabled
+    application.bot_data['http'] = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None)
+    )
+
+async def post_shutdown(application: Application) -> None:
+    """Close the shared HTTP session"""
+    session = application.bot_data.pop('http', None)
+    if session is not None:
+        await session.close()
 
 def main() -> None:
     """Start the bot"""
     # Create the Application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    persistence = PicklePersistence(filepath=PERSISTENCE_FILE, store_data=PERSISTENCE_STORE, update_interval=30)
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(CONCURRENT_UPDATES)  # Handle updates from different users in parallel
+        .connection_pool_size(CONCURRENT_UPDATES)  # Enough Bot API connections for the concurrent handlers
+        .pool_timeout(30)
+        .read_timeout(60)
+        .write_timeout(120)  # Uploading large upscaled documents can take a while
+        .get_updates_connection_pool_size(1)  # Keep long polling off the handler pool
+        # Stay within Telegram's limits (30 msg/s overall, 20 msg/min per group) and
+        # retry once after a RetryAfter (HTTP 429) instead of failing the handler
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=1
+        ))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    # Only updates from the allowed chat reach the handlers
+    allowed_chat = filters.Chat(chat_id=ALLOWED_CHATS)
     
     # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("share", share))  # Add share command handler
-    application.add_handler(CommandHandler("rename", rename))  # Add rename command handler
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_image))
-    application.add_handler(MessageHandler(filters.Document.IMAGE, handle_image))  # Handle document images
+    application.add_handler(CommandHandler("start", start, filters=allowed_chat))
+    application.add_handler(CommandHandler("share", share, filters=allowed_chat))  # Add share command handler
+    application.add_handler(CommandHandler("rename", rename, filters=allowed_chat))  # Add rename command handler
+    application.add_handler(CommandHandler(["start", "share", "rename"], unauthorized, filters=~allowed_chat))
+    application.add_handler(MessageHandler(allowed_chat & filters.TEXT & ~filters.COMMAND, handle_text))
+    application.add_handler(MessageHandler(allowed_chat & filters.PHOTO, handle_image))
+    application.add_handler(MessageHandler(allowed_chat & filters.Document.IMAGE, handle_image))  # Handle document images
     application.add_handler(CallbackQueryHandler(handle_callback))
     
     # Start the bot
     logger.info("Starting bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us, so there is no getUpdates polling loop
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_BOT_TOKEN}",
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
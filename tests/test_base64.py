@@ -0,0 +1,26 @@
+import base64
+import os
+
+import main
+
+
+def test_decode_line_wrapped_base64():
+    """Line breaks in the payload don't break chunked decoding"""
+    image = os.urandom(3 * main.BASE64_DECODE_CHUNK_SIZE + 5)
+    payload = "data:image/png;base64," + base64.encodebytes(image).decode()
+    offset = main.base64_data_offset(payload)
+    with main.decode_base64_to_spool(payload, offset) as image_file:
+        assert image_file.read() == image
+
+
+def test_data_offset_skips_long_prefix():
+    """The data URL prefix is skipped even when its comma is far from the start"""
+    prefix = "data:image/png;name=" + "x" * 100 + ";base64,"
+    assert main.base64_data_offset(prefix + "aGk=") == len(prefix)
+    assert main.base64_data_offset("data:image/png;base64,aGk=") == len("data:image/png;base64,")
+    assert main.base64_data_offset("aGk=") == 0
+
+
+def test_data_offset_without_comma_is_invalid():
+    """A data URL without a comma has no data to decode"""
+    assert main.base64_data_offset("data:image/png;base64") is None
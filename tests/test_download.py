@@ -0,0 +1,41 @@
+import asyncio
+from types import SimpleNamespace
+
+import aiohttp
+import pytest
+from aiohttp import web
+from telegram import Bot
+
+import main
+
+TOKEN = "123:SECRET"
+
+
+async def server_error(request):
+    return web.Response(status=500)
+
+
+def test_download_error_hides_bot_token():
+    """A failed file download raises an error without the tokenized URL"""
+    async def download():
+        app = web.Application()
+        app.router.add_get("/file/bot{token}/{path:.*}", server_error)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                context = SimpleNamespace(
+                    bot=Bot(TOKEN, base_file_url=f"http://127.0.0.1:{port}/file/bot"),
+                    bot_data={'http': session}
+                )
+                await main.get_image_bytes(context, "file-id", "photos/file_0.jpg")
+        finally:
+            await runner.cleanup()
+
+    with pytest.raises(aiohttp.ClientError) as excinfo:
+        asyncio.run(download())
+    assert "500" in str(excinfo.value)
+    assert TOKEN not in str(excinfo.value)
@@ -0,0 +1,28 @@
+import asyncio
+
+import aiohttp
+from telegram.ext import Application, PicklePersistence
+
+import main
+
+
+def test_user_data_survives_restart(tmp_path):
+    """user_data is written and read back while bot_data holds the HTTP session"""
+    filepath = tmp_path / "bot_state.pkl"
+
+    async def save():
+        persistence = PicklePersistence(filepath=filepath, store_data=main.PERSISTENCE_STORE)
+        application = Application.builder().token("123:TEST").persistence(persistence).build()
+        async with aiohttp.ClientSession() as session:
+            application.bot_data['http'] = session
+            application.user_data[1]['photo_file_id'] = "file-id"
+            application.mark_data_for_update_persistence(user_ids=1)
+            await application.update_persistence()
+        await persistence.flush()
+
+    async def load():
+        persistence = PicklePersistence(filepath=filepath, store_data=main.PERSISTENCE_STORE)
+        return await persistence.get_user_data()
+
+    asyncio.run(save())
+    assert asyncio.run(load()) == {1: {'photo_file_id': "file-id"}}
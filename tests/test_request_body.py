@@ -0,0 +1,39 @@
+import asyncio
+import base64
+import os
+
+import orjson
+import pytest
+
+import main
+
+
+async def iter_chunks(data, sizes):
+    """Yield data in chunks of the given sizes, repeating the last size"""
+    start = 0
+    index = 0
+    while start < len(data):
+        size = sizes[min(index, len(sizes) - 1)]
+        yield data[start:start + size]
+        start += size
+        index += 1
+
+
+async def collect(body):
+    return b"".join([part async for part in body])
+
+
+@pytest.mark.parametrize("length", [0, 1, 2, 3, main.BASE64_CHUNK_SIZE + 1, 3 * main.BASE64_CHUNK_SIZE + 2])
+@pytest.mark.parametrize("sizes", [[main.RESPONSE_CHUNK_SIZE], [1, 7, 65537], [main.BASE64_CHUNK_SIZE + 2]])
+def test_streamed_body_matches_json(length, sizes):
+    """The streamed body is byte for byte what orjson makes of the whole image"""
+    image = os.urandom(length)
+    encoded = base64.b64encode(image).decode()
+
+    upscale = asyncio.run(collect(main.stream_image_json(
+        iter_chunks(image, sizes), "base64_data", {"size": "4x"}, include_data_url=True
+    )))
+    assert upscale == orjson.dumps({"size": "4x", "base64_data": main.DATA_URL_PREFIX.decode() + encoded})
+
+    thumbnail = asyncio.run(collect(main.stream_image_json(iter_chunks(image, sizes), "image", {})))
+    assert thumbnail == orjson.dumps({"image": encoded})
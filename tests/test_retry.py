@@ -0,0 +1,69 @@
+import asyncio
+import base64
+import os
+from types import SimpleNamespace
+
+import aiohttp
+import orjson
+from aiohttp import web
+from telegram import Bot
+
+import main
+
+IMAGE = os.urandom(300 * 1024)
+
+
+def test_retry_rebuilds_body_without_downloading_again():
+    """A 503 is retried with a fresh body built from the cached download"""
+    downloads = []
+    bodies = []
+
+    async def download(request):
+        downloads.append(request.path)
+        return web.Response(body=IMAGE)
+
+    async def upscale(request):
+        bodies.append(await request.read())
+        if len(bodies) == 1:
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        return web.json_response({"url": "https://example.com/result.png"})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/file/bot{token}/{path:.*}", download)
+        app.router.add_post("/upscale", upscale)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                context = SimpleNamespace(
+                    bot=Bot("123:TEST", base_file_url=f"http://127.0.0.1:{port}/file/bot"),
+                    bot_data={'http': session}
+                )
+
+                def make_body():
+                    return main.stream_image_json(
+                        main.iter_image_chunks(context, "retry-file-id", "photos/file_0.jpg"),
+                        "base64_data",
+                        {"size": "4x"},
+                        include_data_url=True
+                    )
+
+                async with await main.request_with_retry(
+                    session, "POST", f"http://127.0.0.1:{port}/upscale", make_body=make_body
+                ) as response:
+                    return response.status
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == 200
+    assert len(downloads) == 1
+    assert len(bodies) == 2
+    assert bodies[0] == bodies[1]
+    assert bodies[1] == orjson.dumps({
+        "size": "4x",
+        "base64_data": main.DATA_URL_PREFIX.decode() + base64.b64encode(IMAGE).decode()
+    })
@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+import main
+
+
+def make_spool(size):
+    image_file = tempfile.SpooledTemporaryFile(max_size=main.SPOOL_MAX_SIZE)
+    image_file.write(os.urandom(size))
+    image_file.seek(0)
+    return image_file
+
+
+def test_small_result_stays_in_memory():
+    """Results below SPOOL_MAX_SIZE are uploaded as bytes and never hit the disk"""
+    with make_spool(1024) as image_file:
+        upload = main.spool_upload(image_file, "thumbnail.png")
+        assert isinstance(upload.input_file_content, bytes)
+        assert len(upload.input_file_content) == 1024
+        assert not image_file._rolled
+
+
+def test_large_result_streams_from_disk():
+    """Results spooled to disk are handed to the upload as the file itself"""
+    with make_spool(main.SPOOL_MAX_SIZE + 1) as image_file:
+        upload = main.spool_upload(image_file, "upscaled_8x.png")
+        assert upload.input_file_content is image_file
+        assert image_file.tell() == 0
@@ -0,0 +1,27 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import NetworkError
+
+import main
+
+
+async def failing_chat_action(**kwargs):
+    raise NetworkError("chat action failed")
+
+
+def make_context():
+    return SimpleNamespace(bot=SimpleNamespace(send_chat_action=failing_chat_action))
+
+
+def test_failed_chat_action_keeps_result():
+    """A failing upload indicator doesn't discard the decoded result"""
+    result = asyncio.run(main.run_with_upload_action(make_context(), 1, main.pybase64.b64decode, "aGk=", validate=False))
+    assert result == b"hi"
+
+
+def test_worker_error_is_raised():
+    """Errors from the worker thread still reach the caller"""
+    with pytest.raises(ValueError):
+        asyncio.run(main.run_with_upload_action(make_context(), 1, int, "not a number"))